@@ -6,94 +6,515 @@ GPU-accelerated object detection using YOLO11 models with optional RTSP output
 
 import sys
 import os
+import math
+import functools
+import threading
+import stat
+import pickle
+import tempfile
+import hashlib
+import configparser
+from dataclasses import dataclass
+from typing import Optional
 import gi
 gi.require_version('Gst', '1.0')
 gi.require_version('GstRtspServer', '1.0')
 from gi.repository import Gst, GLib, GstRtspServer
 
-def create_filtered_config(base_config, target_object):
-    """Create a filtered config that only detects the target object"""
-    
-    # Read labels to find class ID
-    labels_path = "/models/labels.txt"
-    target_class_id = None
+def new_config_parser():
+    """Create a parser for nvinfer configs (GKeyFile/INI files)"""
+    
+    config = configparser.ConfigParser(
+        strict=False, interpolation=None, inline_comment_prefixes=(';', '#')
+    )
+    config.optionxform = str  # keep keys exactly as nvinfer expects them
+    return config
+
+
+# Bump when the cached tuple layout changes so stale pickles are ignored
+CONFIG_CACHE_VERSION = 2
+
+
+def config_cache_dir():
+    """Return a private (0700, owned by us) cache directory, or None if it is not safe to use"""
     
+    cache_dir = os.path.join(tempfile.gettempdir(), f"ds_cfg_cache_{os.getuid()}")
     try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        # Unpickling runs code, so refuse a directory another user could have planted or can write to
+        st = os.lstat(cache_dir)
+    except OSError as e:
+        print(f"Warning: Could not create config cache directory: {e}")
+        return None
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        print(f"Warning: Ignoring unsafe config cache directory: {cache_dir}")
+        return None
+    return cache_dir
+
+
+def load_config_sources(labels_path, base_config):
+    """Load labels, base config sections and base class attributes, cached as a pickle keyed by mtime"""
+    
+    # A missing labels file only disables class filtering, the config is still needed
+    labels_mtime = os.path.getmtime(labels_path) if os.path.exists(labels_path) else None
+    
+    cache_dir = config_cache_dir()
+    if cache_dir:
+        key = hashlib.md5(
+            f"v{CONFIG_CACHE_VERSION}:{labels_path}:{labels_mtime}:"
+            f"{base_config}:{os.path.getmtime(base_config)}".encode()
+        ).hexdigest()
+        cache_path = os.path.join(cache_dir, f"{key}.pkl")
+        
+        try:
+            with open(cache_path, 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            # Corrupt or foreign cache entry: re-parse and overwrite it
+            print(f"Warning: Ignoring unreadable config cache {cache_path}: {e}")
+    
+    labels = []
+    if labels_mtime is not None:
         with open(labels_path, 'r') as f:
-            for idx, line in enumerate(f):
-                if line.strip() == target_object:
-                    target_class_id = idx
-                    break
-    except FileNotFoundError:
-        print(f"Warning: Could not find '{labels_path}'")
+            labels = [label.strip() for label in f.read().splitlines()]
+    
+    config = new_config_parser()
+    config.read(base_config)
+    class_attrs = dict(config['class-attrs-all']) if config.has_section('class-attrs-all') else {}
+    # Per-class sections are always regenerated, so strip them once here
+    config_dict = {
+        section: dict(config[section])
+        for section in config.sections()
+        if not section.startswith('class-attrs-')
+    }
+    
+    if cache_dir:
+        # Write to a temp file and rename, so readers never see a partial pickle
+        tmp_path = None
+        try:
+            with tempfile.NamedTemporaryFile('wb', dir=cache_dir, delete=False) as f:
+                tmp_path = f.name
+                pickle.dump((labels, config_dict, class_attrs), f)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"Warning: Could not cache parsed config: {e}")
+            if tmp_path and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+    
+    return labels, config_dict, class_attrs
+
+
+# nvinfer network-mode values for each TensorRT precision
+NETWORK_MODES = {
+    'fp32': 0,
+    'int8': 1,
+    'fp16': 2,
+}
+
+
+def create_filtered_config(base_config, target_object, batch_size=1, precision='fp16', int8_calib=None,
+                           interval=0, gpu_id=0, temp_config_path="/tmp/config_infer_filtered.txt"):
+    """Create a filtered config that only detects the target object"""
+    
+    labels_path = "/models/labels.txt"
+    if not os.path.exists(base_config):
+        print(f"Error: Config file not found: {base_config}")
         return base_config, None
     
-    if target_class_id is None:
+    # Read labels and base config (parsed once, then served from the pickle cache)
+    labels, config_dict, class_attrs = load_config_sources(labels_path, base_config)
+    
+    # Find class ID; without one the [property] overrides below still apply
+    target_class_id = None
+    if not labels:
+        print(f"Warning: Could not find '{labels_path}'")
+        print("Class filtering: DISABLED - Showing all detections")
+    elif target_object not in labels:
         print(f"Warning: Could not find '{target_object}' in labels file")
         print("Class filtering: DISABLED - Showing all detections")
-        return base_config, None
-    
-    print(f"Target object '{target_object}' (class ID: {target_class_id})")
-    print("Class filtering: ENABLED - Only showing '{}' detections".format(target_object))
+    else:
+        target_class_id = labels.index(target_object)
+        print(f"Target object '{target_object}' (class ID: {target_class_id})")
+        print("Class filtering: ENABLED - Only showing '{}' detections".format(target_object))
     
-    # Read base config
-    try:
-        with open(base_config, 'r') as f:
-            config_content = f.read()
-    except FileNotFoundError:
-        print(f"Error: Config file not found: {base_config}")
-        return base_config, None
+    config = new_config_parser()
+    config.read_dict(config_dict)
     
     # Create filtered config
-    temp_config_path = "/tmp/config_infer_filtered.txt"
-    new_config = []
-    in_class_attrs = False
+    properties = config['property']
+    
+    if precision not in NETWORK_MODES:
+        print(f"Warning: Unsupported PRECISION '{precision}', falling back to fp16")
+        precision = 'fp16'
+    
+    # Fix the model-engine-file path to point to /workdir
+    if 'model-engine-file' in properties:
+        filename = os.path.basename(properties['model-engine-file'])
+        # Change to the actual generated engine name (engines are built per batch size, GPU and precision)
+        if 'yolo11s' in filename:
+            properties['model-engine-file'] = f'/workdir/model_b{batch_size}_gpu{gpu_id}_{precision}.engine'
+        elif 'yolo11n' in filename:
+            properties['model-engine-file'] = f'/workdir/yolo11n_b{batch_size}_gpu{gpu_id}_{precision}.engine'
+    
+    # Match the engine batch size to the number of input streams
+    properties['batch-size'] = str(batch_size)
+    
+    # Run inference on the GPU selected for this pipeline
+    properties['gpu-id'] = str(gpu_id)
+    
+    # Skip inference on `interval` frames between inferred ones (tracker fills the gaps)
+    properties['interval'] = str(interval)
+    
+    # Build the TensorRT engine at the requested precision
+    properties['network-mode'] = str(NETWORK_MODES[precision])
+    if precision == 'int8':
+        if int8_calib:
+            properties['int8-calib-file'] = int8_calib
+        elif 'int8-calib-file' not in properties:
+            print("Warning: PRECISION=int8 without INT8_CALIB, TensorRT will use uncalibrated ranges")
     
-    for line in config_content.split('\n'):
-        if line.strip().startswith('[class-attrs-all]'):
-            in_class_attrs = True
-            continue
-        elif in_class_attrs and line.strip().startswith('['):
-            in_class_attrs = False
+    if target_class_id is None:
+        # No filtering: keep the base per-class attributes as they were
+        if class_attrs:
+            config['class-attrs-all'] = class_attrs
+    else:
+        # Add filtered class attributes for target class
+        config[f'class-attrs-{target_class_id}'] = {**class_attrs, 'pre-cluster-threshold': '0.25'}
         
-        if not in_class_attrs:
-            # Fix the model-engine-file path to point to /workdir
-            if line.strip().startswith('model-engine-file='):
-                # Extract just the filename and point to /workdir
-                original_path = line.split('=', 1)[1].strip()
-                filename = os.path.basename(original_path)
-                # Change to the actual generated engine name
-                if 'yolo11s' in filename:
-                    line = 'model-engine-file=/workdir/model_b1_gpu0_fp32.engine'
-                elif 'yolo11n' in filename:
-                    line = 'model-engine-file=/workdir/yolo11n_b1_gpu0_fp32.engine'
-            new_config.append(line)
-    
-    # Add filtered class attributes for target class
-    new_config.append(f"\n[class-attrs-{target_class_id}]")
-    new_config.append("pre-cluster-threshold=0.25")
-    
-    # Add high threshold for all other classes to hide them
-    new_config.append("\n[class-attrs-all]")
-    new_config.append("pre-cluster-threshold=1.0")  # Impossible threshold to hide other classes
+        # Add high threshold for all other classes to hide them, keeping the base NMS/topk settings
+        # (1.0 is an impossible confidence, so nothing else is ever drawn)
+        config['class-attrs-all'] = {**class_attrs, 'pre-cluster-threshold': '1.0'}
     
     # Write filtered config
     with open(temp_config_path, 'w') as f:
-        f.write('\n'.join(new_config))
+        config.write(f, space_around_delimiters=False)
     
     print(f"✓ Created filtered config: {temp_config_path}")
     return temp_config_path, target_class_id
 
 
-def setup_rtsp_server(pipeline_str, port, mount_point):
-    """Setup RTSP server with the detection pipeline"""
+# Low-footprint NvDCF tracker shipped with DeepStream, used when inference skips frames
+DEEPSTREAM_DIR = "/opt/nvidia/deepstream/deepstream"
+TRACKER_LIB = f"{DEEPSTREAM_DIR}/lib/libnvds_nvmultiobjecttracker.so"
+TRACKER_CONFIG = f"{DEEPSTREAM_DIR}/samples/configs/deepstream-app/config_tracker_NvDCF_perf.yml"
+
+# Jetson (Tegra) encoders expose a different set of NVENC properties than dGPU
+IS_JETSON = os.path.exists('/etc/nv_tegra_release')
+
+# Caps pinned on every raw video link so buffers never fall back to system memory
+NVMM_CAPS = "video/x-raw(memory:NVMM)"
+
+# NVENC tuning-info-id values for nvv4l2h26xenc
+NVENC_TUNING = {
+    'hq': 1,
+    'low-latency': 2,
+    'ultra-low-latency': 3,
+    'lossless': 4,
+}
+
+# NVENC rate-control modes for nvv4l2h26xenc control-rate
+NVENC_RATE_CONTROL = {
+    'vbr': 0,
+    'cbr': 1,
+}
+
+
+def make_element(factory_name, name=None, **properties):
+    """Create a GStreamer element, setting properties given as snake_case kwargs"""
+    
+    element = Gst.ElementFactory.make(factory_name, name)
+    if element is None:
+        raise RuntimeError(f"Could not create '{factory_name}' element - is the plugin installed?")
+    for key, value in properties.items():
+        element.set_property(key.replace('_', '-'), value)
+    return element
+
+
+def link(src, dest, caps=NVMM_CAPS, dest_pad=None):
+    """Link two elements, pinning the caps between them when given"""
+    
+    filter_caps = Gst.Caps.from_string(caps) if caps else None
+    if not src.link_pads_filtered(None, dest, dest_pad, filter_caps):
+        raise RuntimeError(f"Could not link {src.get_name()} -> {dest.get_name()}")
+
+
+def add_and_link(container, elements, caps=NVMM_CAPS):
+    """Add elements to a bin and link them in order"""
+    
+    for element in elements:
+        container.add(element)
+    for src, dest in zip(elements, elements[1:]):
+        link(src, dest, caps)
+    return elements
+
+
+def make_leaky_queue(max_buffers=4):
+    """Create a small queue that drops the oldest frames instead of stalling upstream"""
+    
+    # Only the buffer count bounds the queue; leaky=2 drops downstream (oldest) buffers
+    return make_element('queue', max_size_buffers=max_buffers, max_size_bytes=0, max_size_time=0, leaky=2)
+
+
+def on_source_pad_added(src, pad, sink_pad):
+    """Link a decodebin-style source's video pad once it appears"""
+    
+    caps = pad.get_current_caps() or pad.query_caps(None)
+    if not caps.get_structure(0).get_name().startswith('video/'):
+        return
+    
+    if sink_pad.is_linked():
+        return
+    if pad.link(sink_pad) != Gst.PadLinkReturn.OK:
+        print(f"Error: Could not link {src.get_name()}:{pad.get_name()} -> {sink_pad.get_name()}")
+
+
+def source_uri(device):
+    """Convert an input entry into a URI that nvurisrcbin/nvmultiurisrcbin accept"""
+    
+    if '://' in device:
+        return device
+    if device.startswith('/dev/video'):
+        return f"v4l2://{device}"
+    if device != 'test' and os.path.isfile(device):
+        return f"file://{os.path.abspath(device)}"
+    raise RuntimeError(
+        f"Input '{device}' is not a URI, V4L2 device or existing file"
+    )
+
+
+def build_source(container, devices, width, height, latency=200, reconnect_interval=5, gpu_id=0):
+    """Build the input branch, returning its elements ending in batched NVMM frames"""
+    
+    batch_size = len(devices)
+    if batch_size > 1:
+        # Multiple sources: nvmultiurisrcbin decodes and batches all streams itself
+        src = make_element(
+            'nvmultiurisrcbin',
+            uri_list=','.join(devices),
+            max_batch_size=batch_size,
+            live_source=True,
+            batched_push_timeout=40000,
+            latency=latency,
+            drop_on_latency=True,
+            rtsp_reconnect_interval=reconnect_interval,
+            width=width,
+            height=height,
+            gpu_id=gpu_id,
+            # The URI list is static, so skip the REST server; with several instances
+            # each bin would otherwise try to bind the default port 9000
+            port='0',
+        )
+        container.add(src)
+        return [src]
+    
+    device = devices[0]
+    # nvbuf-memory-type=0 keeps the batch in default CUDA device memory on gpu-id
+    mux = make_element(
+        'nvstreammux', width=width, height=height, batch_size=1, gpu_id=gpu_id, nvbuf_memory_type=0
+    )
+    
+    if device == 'test':
+        # Test pattern (quality is irrelevant, so use nearest-neighbour scaling)
+        src = make_element('videotestsrc')
+        conv = make_element('nvvideoconvert', interpolation_method=0, gpu_id=gpu_id, nvbuf_memory_type=0)
+    elif device.startswith('/dev/video'):
+        src = make_element('v4l2src', device=device)
+        mux.set_property('live-source', True)
+        # Raw system-memory frames need one upload/convert into NV12 NVMM
+        conv = make_element('nvvideoconvert', gpu_id=gpu_id, nvbuf_memory_type=0)
+    else:
+        uri = source_uri(device)
+        # Bound the jitterbuffer instead of the 2s default, dropping late packets
+        # (the RTSP properties are ignored for other URI schemes)
+        src = make_element(
+            'nvurisrcbin',
+            uri=uri,
+            latency=latency,
+            drop_on_latency=True,
+            rtsp_reconnect_interval=reconnect_interval,
+            gpu_id=gpu_id,
+        )
+        if not uri.startswith('file://'):
+            mux.set_property('live-source', True)
+        # nvurisrcbin already decodes to NV12 NVMM, so no converter is needed; the
+        # queue keeps jitterbuffer variance from stalling nvstreammux
+        queue = make_leaky_queue()
+        container.add(src)
+        container.add(queue)
+        container.add(mux)
+        src.connect('pad-added', on_source_pad_added, queue.get_static_pad('sink'))
+        link(queue, mux, dest_pad='sink_0')
+        return [src, queue, mux]
+    
+    add_and_link(container, [src, conv], caps=None)
+    container.add(mux)
+    link(conv, mux, f"{NVMM_CAPS},format=NV12", dest_pad='sink_0')
+    return [src, conv, mux]
+
+
+def build_inference(container, final_config, batch_size, width, height, interval=0,
+                    tracker_config=TRACKER_CONFIG, gpu_id=0):
+    """Build the nvinfer -> nvdsosd tail shared by every input type"""
+    
+    stages = [make_element(
+        'nvinfer',
+        config_file_path=final_config,
+        batch_size=batch_size,
+        interval=interval,
+        gpu_id=gpu_id,
+    )]
+    if interval > 0:
+        # Track objects so frames skipped by nvinfer still carry boxes
+        stages.append(make_element(
+            'nvtracker',
+            ll_lib_file=TRACKER_LIB,
+            ll_config_file=tracker_config,
+            tracker_width=640,
+            tracker_height=384,
+            gpu_id=gpu_id,
+        ))
+    if batch_size > 1:
+        # Composite the batch back into a single output frame
+        columns = math.ceil(math.sqrt(batch_size))
+        rows = math.ceil(batch_size / columns)
+        stages.append(make_element(
+            'nvmultistreamtiler',
+            rows=rows,
+            columns=columns,
+            width=width,
+            height=height,
+            gpu_id=gpu_id,
+        ))
+    # Queues around nvdsosd give OSD and the output sink their own streaming threads,
+    # so an encoder stall drops frames here instead of back-pressuring decode/infer
+    stages.append(make_leaky_queue())
+    stages.append(make_element('nvdsosd', gpu_id=gpu_id))
+    stages.append(make_leaky_queue())
+    return add_and_link(container, stages)
+
+
+def build_encoder_sink(container, codec, preset, tune, rate_control, bitrate, gop, gpu_id=0):
+    """Build the NVENC -> RTP payloader tail used for RTSP output"""
+    
+    if codec not in ('h264', 'h265'):
+        print(f"Warning: Unsupported RTSP_CODEC '{codec}', falling back to h265")
+        codec = 'h265'
+    
+    # P1 (fastest) .. P7 (slowest, best quality)
+    preset_id = preset.upper().lstrip('P')
+    if not preset_id.isdigit() or not 1 <= int(preset_id) <= 7:
+        print(f"Warning: Invalid NVENC_PRESET '{preset}', falling back to P4")
+        preset_id = 4
+    
+    if tune not in NVENC_TUNING:
+        print(f"Warning: Unsupported NVENC_TUNE '{tune}', falling back to low-latency")
+        tune = 'low-latency'
+    
+    if rate_control not in NVENC_RATE_CONTROL:
+        print(f"Warning: Unsupported NVENC_RC '{rate_control}', falling back to cbr")
+        rate_control = 'cbr'
+    
+    properties = {
+        'control_rate': NVENC_RATE_CONTROL[rate_control],
+        'bitrate': bitrate,
+        'iframeinterval': gop,
+        'insert_sps_pps': True,
+    }
+    if codec == 'h264':
+        properties['profile'] = 2  # Main
+    if IS_JETSON:
+        # Jetson encoders take a coarser preset-level (1=UltraFast .. 4=Slow),
+        # run clocks at max, and skip B-frames, which only add latency for live RTSP
+        properties['preset_level'] = min((int(preset_id) + 1) // 2, 4)
+        properties['maxperf_enable'] = True
+        properties['num_B_Frames'] = 0
+    else:
+        properties['preset_id'] = int(preset_id)
+        properties['tuning_info_id'] = NVENC_TUNING[tune]
+        properties['gpu_id'] = gpu_id
+    enc = make_element(f'nvv4l2{codec}enc', **properties)
+    parse = make_element(f'{codec}parse')
+    pay = make_element(f'rtp{codec}pay', 'pay0', pt=96)
+    
+    # nvdsosd output goes straight to NVENC, which accepts NV12 NVMM as-is
+    return add_and_link(container, [enc, parse, pay], caps=None)
+
+
+def build_detection_pipeline(settings, devices, final_config, gpu_id, container):
+    """Populate a bin with a detection pipeline for the given inputs"""
+    
+    elements = build_source(
+        container,
+        devices,
+        settings.output_width,
+        settings.output_height,
+        settings.rtsp_latency,
+        settings.rtsp_reconnect_interval,
+        gpu_id,
+    )
+    
+    stages = build_inference(
+        container,
+        final_config,
+        len(devices),
+        settings.output_width,
+        settings.output_height,
+        settings.infer_interval,
+        settings.tracker_config,
+        gpu_id,
+    )
+    link(elements[-1], stages[0])
+    elements += stages
+    
+    # Output sink
+    if settings.rtsp_output:
+        sink = build_encoder_sink(
+            container,
+            settings.rtsp_codec,
+            settings.nvenc_preset,
+            settings.nvenc_tune,
+            settings.nvenc_rc,
+            settings.nvenc_bitrate,
+            settings.nvenc_gop,
+            gpu_id,
+        )
+    elif settings.show_display:
+        sink = add_and_link(container, [
+            make_element('nvvideoconvert', gpu_id=gpu_id),
+            make_element('nveglglessink'),
+        ])
+    else:
+        sink = add_and_link(container, [make_element('fakesink')])
+    link(elements[-1], sink[0])
+    elements += sink
+    
+    print(f"Pipeline: {' ! '.join(e.get_factory().get_name() for e in elements)}")
+    return container
+
+
+class DetectionMediaFactory(GstRtspServer.RTSPMediaFactory):
+    """RTSP media factory that builds the detection pipeline element by element"""
+    
+    def __init__(self, build_pipeline):
+        super().__init__()
+        self.build_pipeline = build_pipeline
+    
+    def do_create_element(self, url):
+        try:
+            return self.build_pipeline(Gst.Bin.new('ds-detect'))
+        except RuntimeError as e:
+            print(f"Error: {e}")
+            return None
+
+
+def setup_rtsp_server(port, pipelines, debug=False):
+    """Setup RTSP server with one detection pipeline per mount point"""
     
     server = GstRtspServer.RTSPServer.new()
     server.props.service = port
-    
-    factory = GstRtspServer.RTSPMediaFactory.new()
-    factory.set_launch(pipeline_str)
-    factory.set_shared(True)
+    mounts = server.get_mount_points()
     
     # Connect to factory signals for debugging
     def on_media_constructed(factory, media):
@@ -108,114 +529,266 @@ def setup_rtsp_server(pipeline_str, port, mount_point):
         media.connect("new-stream", on_new_stream)
         media.connect("prepared", on_prepared)
     
-    factory.connect("media-constructed", on_media_constructed)
-    
-    # Add factory to mount points
-    mounts = server.get_mount_points()
-    mounts.add_factory(mount_point, factory)
+    # Add a factory per mount point
+    for mount_point, build_pipeline in pipelines.items():
+        factory = DetectionMediaFactory(build_pipeline)
+        factory.set_shared(True)
+        if debug:
+            factory.connect("media-constructed", on_media_constructed)
+        mounts.add_factory(mount_point, factory)
     
     # Connect to server signals
     def on_client_connected(server, client):
         print(f"DEBUG: Client connected: {client}")
     
-    server.connect("client-connected", on_client_connected)
-    
-    print(f"DEBUG: RTSP server configured for 0.0.0.0:{port}")
-    print(f"DEBUG: Mount point: {mount_point}")
+    # Debug handlers cost a Python callback per signal, so production connects none
+    if debug:
+        server.connect("client-connected", on_client_connected)
+        print(f"DEBUG: RTSP server configured for 0.0.0.0:{port}")
+        print(f"DEBUG: Mount points: {', '.join(pipelines)}")
     
     return server
 
 
+def prebuild_engines(instances):
+    """Build each TensorRT engine shared by several instances once, before any of them start"""
+    
+    # Instances with the same batch size, GPU and precision load the same engine file, and
+    # a cold start would otherwise have them all build and save it at the same time
+    shared = {}
+    for devices, final_config, gpu_id in instances.values():
+        config = new_config_parser()
+        config.read(final_config)
+        engine = config.get('property', 'model-engine-file', fallback=None)
+        if engine and not os.path.exists(engine):
+            shared.setdefault(engine, []).append((final_config, gpu_id))
+    
+    for engine, users in shared.items():
+        if len(users) < 2:
+            continue
+        final_config, gpu_id = users[0]
+        print(f"Building TensorRT engine {engine} before starting the inference streams...")
+        
+        # nvinfer builds and saves a missing engine while it starts (READY -> PAUSED)
+        pipeline = Gst.Pipeline.new('engine-prebuild')
+        pipeline.add(make_element('nvinfer', config_file_path=final_config, gpu_id=gpu_id))
+        if pipeline.set_state(Gst.State.PAUSED) == Gst.StateChangeReturn.FAILURE:
+            print(f"Warning: Could not prebuild {engine}, each instance will build it")
+        pipeline.set_state(Gst.State.NULL)
+
+
+def watch_bus(pipeline, loop):
+    """Block on the pipeline bus for EOS/ERROR/STATE_CHANGED, quitting the loop when done"""
+    
+    bus = pipeline.get_bus()
+    # Other message types are popped and dropped in C without waking Python
+    message_types = Gst.MessageType.EOS | Gst.MessageType.ERROR | Gst.MessageType.STATE_CHANGED
+    
+    # loop.quit goes through idle_add so it is not lost if it races loop.run()
+    while True:
+        message = bus.timed_pop_filtered(Gst.CLOCK_TIME_NONE, message_types)
+        if message is None:
+            continue
+        
+        t = message.type
+        if t == Gst.MessageType.EOS:
+            print("End of stream")
+            GLib.idle_add(loop.quit)
+            return
+        elif t == Gst.MessageType.ERROR:
+            err, debug = message.parse_error()
+            print(f"Error from {message.src.get_name()}: {err.message}")
+            if debug:
+                print(f"Debug info: {debug}")
+            GLib.idle_add(loop.quit)
+            return
+        elif t == Gst.MessageType.STATE_CHANGED:
+            if message.src == pipeline:
+                old_state, new_state, pending_state = message.parse_state_changed()
+                print(f"Pipeline state changed from {old_state.value_nick} to {new_state.value_nick}")
+
+
+def env_int(name, default):
+    """Read an integer environment variable, exiting with a one-line error if it is malformed"""
+    
+    value = os.environ.get(name, default)
+    try:
+        return int(value)
+    except ValueError:
+        print(f"Error: {name} must be an integer, got '{value}'")
+        sys.exit(1)
+
+
+@dataclass
+class Settings:
+    """Runtime settings, read once from the environment at startup"""
+    
+    devices: list
+    target_object: str
+    model_config: str
+    model_engine: str
+    precision: str
+    int8_calib: Optional[str]
+    infer_interval: int
+    tracker_config: str
+    rtsp_latency: int
+    rtsp_reconnect_interval: int
+    show_display: bool
+    rtsp_output: Optional[str]
+    rtsp_port: str
+    output_width: int
+    output_height: int
+    rtsp_codec: str
+    nvenc_preset: str
+    nvenc_tune: str
+    nvenc_rc: str
+    nvenc_bitrate: int
+    nvenc_gop: int
+    nvinfer_streams: int
+    gpu_ids: list
+    debug: bool
+    
+    @classmethod
+    def from_env(cls):
+        env = os.environ
+        device = env.get('GST_DEVICE') or env.get('RTSP_URL') or 'test'
+        output_width = env_int('OUTPUT_WIDTH', '1920')
+        gpu_ids = env.get('GPU_ID', '0')
+        if not all(g.strip().isdigit() for g in gpu_ids.split(',') if g.strip()):
+            print(f"Error: GPU_ID must be an integer or comma-separated integers, got '{gpu_ids}'")
+            sys.exit(1)
+        return cls(
+            # Comma-separated list of inputs are batched through a single nvinfer
+            devices=[d.strip() for d in device.split(',') if d.strip()] or ['test'],
+            target_object=env.get('DETECT_OBJECT', 'person'),
+            model_config=env.get('MODEL_CONFIG', '/models/config_infer_yolo11s.txt'),
+            model_engine=env.get('MODEL_ENGINE', ''),
+            precision=env.get('PRECISION', 'fp16').lower(),
+            int8_calib=env.get('INT8_CALIB'),
+            infer_interval=env_int('INFER_INTERVAL', '0'),
+            tracker_config=env.get('TRACKER_CONFIG', TRACKER_CONFIG),
+            rtsp_latency=env_int('RTSP_LATENCY_MS', '200'),
+            rtsp_reconnect_interval=env_int('RTSP_RECONNECT_INTERVAL', '5'),
+            show_display=env.get('SHOW_DISPLAY', 'true').lower() == 'true',
+            rtsp_output=env.get('RTSP_OUTPUT'),
+            rtsp_port=env.get('RTSP_OUTPUT_PORT', '8555'),
+            output_width=output_width,
+            output_height=env_int('OUTPUT_HEIGHT', '1080'),
+            rtsp_codec=env.get('RTSP_CODEC', 'h265').lower(),
+            # P4 keeps quality up at 4K, P1 keeps latency down for everything else
+            nvenc_preset=env.get('NVENC_PRESET', 'P4' if output_width >= 3840 else 'P1'),
+            nvenc_tune=env.get('NVENC_TUNE', 'low-latency').lower(),
+            nvenc_rc=env.get('NVENC_RC', 'cbr').lower(),
+            nvenc_bitrate=env_int('NVENC_BITRATE', '4000000'),
+            nvenc_gop=env_int('NVENC_GOP', '30'),
+            nvinfer_streams=max(env_int('NVINFER_STREAMS', '1'), 1),
+            # Comma-separated GPU_ID spreads the nvinfer instances across GPUs (ids are
+            # indices into CUDA_VISIBLE_DEVICES)
+            gpu_ids=[int(g) for g in gpu_ids.split(',') if g.strip()] or [0],
+            debug=env.get('DEBUG', '0') == '1',
+        )
+    
+    @property
+    def device(self):
+        return ','.join(self.devices)
+    
+    def device_groups(self):
+        """Round-robin the inputs across the nvinfer instances"""
+        count = min(self.nvinfer_streams, len(self.devices))
+        return [self.devices[i::count] for i in range(count)]
+
+
 def main():
     # Initialize GStreamer
     Gst.init(None)
     
-    # Get environment variables
-    device = os.getenv('GST_DEVICE') or os.getenv('RTSP_URL') or 'test'
-    target_object = os.getenv('DETECT_OBJECT', 'person')
-    model_config = os.getenv('MODEL_CONFIG', '/models/config_infer_yolo11s.txt')
-    model_engine = os.getenv('MODEL_ENGINE', '')
-    show_display = os.getenv('SHOW_DISPLAY', 'true').lower() == 'true'
-    rtsp_output = os.getenv('RTSP_OUTPUT')
-    rtsp_port = os.getenv('RTSP_OUTPUT_PORT', '8555')
-    output_width = os.getenv('OUTPUT_WIDTH', '1920')
-    output_height = os.getenv('OUTPUT_HEIGHT', '1080')
+    # Read all settings from the environment once
+    settings = Settings.from_env()
     
-    # Create filtered config
-    final_config, target_class_id = create_filtered_config(model_config, target_object)
-    
-    # Build pipeline based on input source
-    if device.startswith('rtsp://'):
-        source_pipeline = (
-            f"nvurisrcbin uri={device} ! "
-            f"nvvideoconvert interpolation-method=5 ! "
-            f"m.sink_0 nvstreammux name=m width={output_width} height={output_height} batch-size=1 ! "
-            f"nvinfer config-file-path={final_config} ! "
-            f"nvdsosd"
-        )
-    elif os.path.exists(device) and device.startswith('/dev/video'):
-        source_pipeline = (
-            f"v4l2src device={device} ! "
-            f"nvvideoconvert interpolation-method=5 ! "
-            f"m.sink_0 nvstreammux name=m width={output_width} height={output_height} batch-size=1 ! "
-            f"nvinfer config-file-path={final_config} ! "
-            f"nvdsosd"
-        )
-    else:
-        # Test pattern
-        source_pipeline = (
-            f"videotestsrc ! "
-            f"nvvideoconvert interpolation-method=5 ! "
-            f"m.sink_0 nvstreammux name=m width={output_width} height={output_height} batch-size=1 ! "
-            f"nvinfer config-file-path={final_config} ! "
-            f"nvdsosd"
+    # Each nvinfer instance runs its own TensorRT execution context on its own CUDA
+    # stream, so several instances keep big GPUs busy where one batch cannot
+    instances = {}
+    device_groups = settings.device_groups()
+    for index, devices in enumerate(device_groups):
+        suffix = f"-{index}" if len(device_groups) > 1 else ""
+        gpu_id = settings.gpu_ids[index % len(settings.gpu_ids)]
+        
+        # nvurisrcbin and nvmultiurisrcbin only take URIs; a single input may also be
+        # the test pattern or a V4L2 device, which get their own source elements
+        try:
+            if len(devices) > 1:
+                devices = [source_uri(device) for device in devices]
+            elif devices[0] != 'test' and not devices[0].startswith('/dev/video'):
+                devices = [source_uri(devices[0])]
+        except RuntimeError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        
+        # Create filtered config
+        final_config, target_class_id = create_filtered_config(
+            settings.model_config,
+            settings.target_object,
+            len(devices),
+            settings.precision,
+            settings.int8_calib,
+            settings.infer_interval,
+            gpu_id,
+            f"/tmp/config_infer_filtered{suffix}.txt",
         )
+        instances[f"/ds-detect{suffix}"] = (devices, final_config, gpu_id)
     
-    # Output sink
-    if rtsp_output:
-        output_sink = (
-            f"nvvideoconvert ! video/x-raw(memory:NVMM),format=I420 ! "
-            f"nvv4l2h264enc bitrate=4000000 insert-sps-pps=true ! "
-            f"h264parse ! rtph264pay name=pay0 pt=96"
-        )
-    elif show_display:
-        output_sink = "nvvideoconvert ! nveglglessink"
+    if settings.rtsp_output:
+        output_sink = f"RTSP ({settings.rtsp_codec})"
+    elif settings.show_display:
+        output_sink = "display"
     else:
         output_sink = "fakesink"
     
-    pipeline_str = f"{source_pipeline} ! {output_sink}"
-    
     # Print pipeline info
     print("DeepStream Object Detection Pipeline")
-    print(f"  Input: {device}")
-    print(f"  Target Object: {target_object}")
-    print(f"  Model Engine: {model_engine}")
-    print(f"  Model Config: {final_config}")
-    print(f"  Display: {'enabled' if show_display else 'disabled'}")
-    if rtsp_output:
-        print(f"  RTSP Stream: rtsp://localhost:{rtsp_port}/ds-detect")
-    print(f"  Pipeline: {pipeline_str}")
+    print(f"  Input: {settings.device}")
+    print(f"  Target Object: {settings.target_object}")
+    print(f"  Model Engine: {settings.model_engine}")
+    print(f"  Inference Streams: {len(instances)}")
+    for mount_point, (devices, final_config, gpu_id) in instances.items():
+        print(f"    {mount_point}: {','.join(devices)} "
+              f"(batch-size {len(devices)}, GPU {gpu_id}, config {final_config})")
+    print(f"  Precision: {settings.precision}")
+    tracker_note = ' (nvtracker enabled)' if settings.infer_interval > 0 else ''
+    print(f"  Inference Interval: {settings.infer_interval}{tracker_note}")
+    print(f"  Display: {'enabled' if settings.show_display else 'disabled'}")
+    if settings.rtsp_output:
+        for mount_point in instances:
+            print(f"  RTSP Stream: rtsp://localhost:{settings.rtsp_port}{mount_point}")
     print(f"  Output: {output_sink}")
     print("\nNote: This uses DeepStream's nvinfer element for GPU-accelerated inference")
     print("      nvdsosd draws bounding boxes and labels on detected objects")
     print("      You can customize the model by setting MODEL_CONFIG environment variable")
     
+    try:
+        prebuild_engines(instances)
+    except RuntimeError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    
     # Handle RTSP server if RTSP output is enabled
-    if rtsp_output:
-        print(f"      RTSP stream available at rtsp://localhost:{rtsp_port}/ds-detect")
-        print(f"      View with: ffplay rtsp://localhost:{rtsp_port}/ds-detect")
+    if settings.rtsp_output:
+        for mount_point in instances:
+            print(f"      RTSP stream available at rtsp://localhost:{settings.rtsp_port}{mount_point}")
+            print(f"      View with: ffplay rtsp://localhost:{settings.rtsp_port}{mount_point}")
         print("\nStarting RTSP server...")
         
-        print(f"DEBUG: Setting pipeline: {pipeline_str}")
-        
-        # Create RTSP server
-        server = setup_rtsp_server(pipeline_str, rtsp_port, "/ds-detect")
+        # Create RTSP server (the pipeline is built when the first client connects)
+        server = setup_rtsp_server(settings.rtsp_port, {
+            mount_point: functools.partial(build_detection_pipeline, settings, devices, final_config, gpu_id)
+            for mount_point, (devices, final_config, gpu_id) in instances.items()
+        }, settings.debug)
         
         # Attach server to main context
         server.attach(None)
         
-        print(f"RTSP server started on port {rtsp_port}")
-        print(f"Server bound to 0.0.0.0:{rtsp_port}")
+        print(f"RTSP server started on port {settings.rtsp_port}")
+        print(f"Server bound to 0.0.0.0:{settings.rtsp_port}")
         print("Waiting for RTSP clients to connect...")
         print("Press Ctrl+C to stop the server")
         
@@ -229,35 +802,23 @@ def main():
         return
     
     # Create pipeline (only if not using RTSP server)
-    pipeline = Gst.parse_launch(pipeline_str)
-    
-    # Get bus for messages
-    bus = pipeline.get_bus()
-    bus.add_signal_watch()
-    
-    def on_message(bus, message):
-        t = message.type
-        if t == Gst.MessageType.EOS:
-            print("End of stream")
-            loop.quit()
-        elif t == Gst.MessageType.ERROR:
-            err, debug = message.parse_error()
-            print(f"Error from {message.src.get_name()}: {err.message}")
-            if debug:
-                print(f"Debug info: {debug}")
-            loop.quit()
-        elif t == Gst.MessageType.STATE_CHANGED:
-            if message.src == pipeline:
-                old_state, new_state, pending_state = message.parse_state_changed()
-                print(f"Pipeline state changed from {old_state.value_nick} to {new_state.value_nick}")
+    pipeline = Gst.Pipeline.new('ds-detect')
+    try:
+        for devices, final_config, gpu_id in instances.values():
+            build_detection_pipeline(settings, devices, final_config, gpu_id, pipeline)
+    except RuntimeError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
     
-    bus.connect("message", on_message)
+    # Watch the bus from a helper thread that only wakes for the messages we handle
+    loop = GLib.MainLoop()
+    watcher = threading.Thread(target=watch_bus, args=(pipeline, loop), daemon=True)
+    watcher.start()
     
     # Start playing
     pipeline.set_state(Gst.State.PLAYING)
     
     # Run main loop
-    loop = GLib.MainLoop()
     try:
         loop.run()
     except KeyboardInterrupt: